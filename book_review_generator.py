@@ -3,7 +3,7 @@
 Book Review Generator using Nvidia DeepSeek R1 API
 
 This script:
-1. Allows user to select an MD file (default: top25Book_douban.md)
+1. Takes an MD file from the command line or a file dialog (default: top25Book_douban.md)
 2. Reads book data from the selected file
 3. Generates book reviews using the Nvidia DeepSeek R1 API
 4. Saves reviews as markdown files in the bookComments folder
@@ -14,46 +14,223 @@ but requests during high traffic may experience delays.
 
 import os
 import re
-import json
+import mmap
+import stat
+import asyncio
 import time
+import random
+import email.utils
+import hashlib
+import threading
+import orjson
 import requests
-import tkinter as tk
 import argparse
-from tkinter import filedialog
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
+API_KEY = os.environ.get("api_key")
 
 # Constants
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_FILE = "top25Book_douban.md"
 DEFAULT_OUTPUT_DIR = "bookComments"
+CACHE_DIR = Path(".review_cache")
+MANIFEST_FILE = ".reviews_done.json"
 NVIDIA_API_URL = "https://integrate.api.nvidia.com/v1/chat/completions"
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MIN_INTERVAL = 2.0
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 16
+MAX_OVERLOAD_RETRIES = 6
+RETRY_BACKOFF_FACTOR = 1.5
+RETRY_BACKOFF_JITTER = 1.0
+# Seconds to wait for the connection, and for the next bytes of the stream before
+# a stalled connection is treated as dropped
+REQUEST_TIMEOUT = (10, 120)
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+REJECTED_STATUSES = (400, 422)
+# The endpoint caps responses at MAX_TOKENS and R1's <think> reasoning counts against it,
+# so only two 300-500 character reviews fit reliably in one response
+MAX_BATCH_SIZE = 2
+MAX_TOKENS = 4096
+BOOK_SEPARATOR = "<<<BOOK_SEP>>>"
+WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB
+BOOK_FIELDS = ('rank', 'title', 'author', 'original_title', 'year',
+               'translator', 'publisher', 'rating', 'comment')
+FILENAME_SANITIZE_RE = re.compile(r'[\\/*?:"<>|]')
+THINK_OPEN_TAG = "<think>"
+THINK_CLOSE_TAG = "</think>"
+DUMMY_REVIEW_MARKER = "【这是一个模拟生成的书评，没有实际调用API】"
 
 def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Generate book reviews using Nvidia DeepSeek R1 API.')
+    parser.add_argument('input', nargs='?', default=os.path.join(SCRIPT_DIR, DEFAULT_FILE),
+                        help=f'Markdown file with the book list (default: {DEFAULT_FILE})')
+    parser.add_argument('--gui', action='store_true',
+                        help='Select the input file with a file dialog instead')
     parser.add_argument('--output-dir', type=str, default=DEFAULT_OUTPUT_DIR,
                         help=f'Output directory for reviews (default: {DEFAULT_OUTPUT_DIR})')
     parser.add_argument('--dry-run', action='store_true',
                         help='Run in dry-run mode (no API calls)')
     parser.add_argument('--no-overwrite', action='store_true',
                         help='Skip books that already have reviews (do not overwrite)')
-    return parser.parse_args()
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'Always call the API instead of reusing cached responses from {CACHE_DIR}')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'Initial number of concurrent API requests, adjusted automatically '
+                             f'when the API is overloaded (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--min-interval', type=float, default=DEFAULT_MIN_INTERVAL,
+                        help=f'Minimum seconds between starting two API requests (default: {DEFAULT_MIN_INTERVAL:g})')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help=f'Number of books to review per API request (default: 1, max: {MAX_BATCH_SIZE})')
+    args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.min_interval < 0:
+        parser.error('--min-interval must not be negative')
+    if not 1 <= args.batch_size <= MAX_BATCH_SIZE:
+        parser.error(f'--batch-size must be between 1 and {MAX_BATCH_SIZE}')
+    return args
+
+class RateLimitError(Exception):
+    """Raised when the API reports it is overloaded (HTTP 429 or a transient 5xx).
+
+    ``retry_after`` is the delay in seconds asked for by the server's Retry-After
+    header, or None if it sent none.
+    """
+    
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class StreamInterruptedError(Exception):
+    """Raised when the connection fails while a streamed response is being read."""
+
+class RequestRejectedError(Exception):
+    """Raised when the API rejects a request as invalid (HTTP 400 or 422)."""
+
+class IncompleteResponseError(Exception):
+    """Raised when an API response was cut off or does not contain one review per book."""
+
+class AdaptiveConcurrencyLimiter:
+    """Limit in-flight API requests using AIMD (additive increase, multiplicative decrease).
+
+    The limit grows by roughly one slot per window of successful requests and is
+    multiplied by ``decrease_factor`` when a request reports an overload. Requests
+    that failed for other reasons leave it unchanged.
+    """
+    
+    def __init__(self, initial, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY, decrease_factor=0.5):
+        self.minimum = minimum
+        self.maximum = max(maximum, initial)
+        self.decrease_factor = decrease_factor
+        self.limit = float(initial)
+        self.in_flight = 0
+        # Bumped on every decrease so one overload window only shrinks the limit once
+        self._generation = 0
+        self._condition = asyncio.Condition()
+    
+    async def acquire(self):
+        """Wait for a free slot and return the generation it was acquired in."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            return self._generation
+    
+    async def release(self, generation, overloaded=False, succeeded=True):
+        """Free a slot and adjust the limit based on the request outcome."""
+        async with self._condition:
+            self.in_flight -= 1
+            if not overloaded:
+                if succeeded:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif generation == self._generation:
+                previous = int(self.limit)
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self._generation += 1
+                if int(self.limit) < previous:
+                    print(f"API过载，并发数降至 {int(self.limit)}")
+            self._condition.notify_all()
+
+class RequestPacer:
+    """Keep the start of consecutive API requests at least min_interval seconds apart.
+
+    Only the part of the interval that has not already elapsed since the previous
+    dispatch is waited for, so a slow request is not followed by extra idle time.
+    """
+    
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._next_dispatch = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def wait(self):
+        """Wait until the next request may be dispatched."""
+        async with self._lock:
+            delay = self._next_dispatch - time.monotonic()
+            if delay > 0:
+                print(f"等待 {delay:.1f} 秒以避免API限流...")
+                await asyncio.sleep(delay)
+            self._next_dispatch = time.monotonic() + self.min_interval
+
+def parse_retry_after(value):
+    """Convert a Retry-After header (seconds or an HTTP date) to seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def create_session(pool_size=MAX_CONCURRENCY):
+    """Create a requests session that keeps connections to the API alive between books.
+
+    ``pool_size`` should be at least the number of requests that can be in flight,
+    otherwise surplus connections are discarded and each costs a new TLS handshake.
+    """
+    session = requests.Session()
+    # Retry connection and read errors with exponential backoff and jitter (POST has to be
+    # allowed explicitly). This only covers the request up to the response headers;
+    # errors while the streamed body is read are retried by run_limited(). HTTP 429/5xx
+    # are not retried here either: run_limited() retries them so the adaptive limiter
+    # sees every overload.
+    # respect_retry_after_header is switched off because urllib3 would otherwise still
+    # retry 429/503 responses that carry a Retry-After header.
+    retries = Retry(total=MAX_OVERLOAD_RETRIES, backoff_factor=RETRY_BACKOFF_FACTOR,
+                    backoff_jitter=RETRY_BACKOFF_JITTER, allowed_methods=["POST"],
+                    respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
 
 def select_file():
     """Open a file dialog to select an MD file, defaulting to top25Book_douban.md."""
+    # Imported here so runs without --gui do not load Tk (and work without a display)
+    import tkinter as tk
+    from tkinter import filedialog
+    
     root = tk.Tk()
     root.withdraw()  # Hide the main window
     
-    # Get the current directory
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    default_file = os.path.join(current_dir, DEFAULT_FILE)
+    default_file = os.path.join(SCRIPT_DIR, DEFAULT_FILE)
     
     # Open file dialog with the default file selected
     file_path = filedialog.askopenfilename(
-        initialdir=current_dir,
+        initialdir=SCRIPT_DIR,
         initialfile=DEFAULT_FILE,
         title="Select a book list file",
         filetypes=(("Markdown files", "*.md"), ("All files", "*.*"))
@@ -71,29 +248,30 @@ def select_file():
 
 def parse_book_data(file_path):
     """Parse book data from the markdown file."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # Find table rows
-    table_pattern = r'\|\s*(\d+)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|'
-    rows = re.findall(table_pattern, content)
-    
+    with open(file_path, 'rb') as f:
+        info = os.fstat(f.fileno())
+        # mmap only works on non-empty regular files; pipes and FIFOs
+        # (e.g. <(cat list.md)) are read line by line from the file object
+        if not stat.S_ISREG(info.st_mode) or info.st_size == 0:
+            return parse_book_lines(f)
+        # Map the file and walk it line by line so only table rows are ever decoded
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return parse_book_lines(iter(mm.readline, b""))
+
+def parse_book_lines(raw_lines):
+    """Parse book rows from an iterable of raw (bytes) markdown lines."""
     books = []
-    for row in rows:
-        # Skip header row or separator row (if any)
-        if row[0].isdigit():
-            book = {
-                'rank': row[0],
-                'title': row[1].strip(),
-                'author': row[2].strip(),
-                'original_title': row[3].strip(),
-                'year': row[4].strip(),
-                'translator': row[5].strip(),
-                'publisher': row[6].strip(),
-                'rating': row[7].strip(),
-                'comment': row[8].strip()
-            }
-            books.append(book)
+    for raw_line in raw_lines:
+        # Only table rows are of interest
+        raw_line = raw_line.strip()
+        if not raw_line.startswith(b'|'):
+            continue
+        line = raw_line.decode('utf-8')
+        cells = [cell.strip() for cell in line.split('|')[1:-1]]
+        # Skip header row, separator row and malformed rows
+        if len(cells) != len(BOOK_FIELDS) or not cells[0].isdigit():
+            continue
+        books.append(dict(zip(BOOK_FIELDS, cells)))
     
     return books
 
@@ -101,12 +279,46 @@ def remove_think_tags(content):
     """Remove content within <think>...</think> tags."""
     if not content:
         return content
-    # Remove think tags and their contents
-    return re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
+    # Scan for literal tags instead of using a regex; an unclosed block is kept as-is
+    parts = []
+    pos = 0
+    while True:
+        start = content.find(THINK_OPEN_TAG, pos)
+        if start == -1:
+            break
+        end = content.find(THINK_CLOSE_TAG, start + len(THINK_OPEN_TAG))
+        if end == -1:
+            break
+        parts.append(content[pos:start])
+        pos = end + len(THINK_CLOSE_TAG)
+    parts.append(content[pos:])
+    return "".join(parts)
+
+def get_cache_path(body):
+    """Get the cache file for a serialized API payload, keyed by a hash of the whole payload."""
+    key = hashlib.sha256(body).hexdigest()
+    return CACHE_DIR / f"{key}.json"
+
+def load_cached_response(cache_path):
+    """Load a cached API response, returning None on a cache miss."""
+    try:
+        with open(cache_path, 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def save_cached_response(cache_path, result):
+    """Store a raw API response in the cache."""
+    CACHE_DIR.mkdir(exist_ok=True)
+    # Write to a temporary file first so a partially written entry is never read back
+    tmp_path = cache_path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(result))
+    os.replace(tmp_path, cache_path)
 
 def generate_dummy_review(book):
     """Generate a dummy review for dry-run mode."""
-    return f"""【这是一个模拟生成的书评，没有实际调用API】
+    return f"""{DUMMY_REVIEW_MARKER}
 
 《{book['title']}》是一本令人印象深刻的作品，豆瓣评分高达{book['rating']}分！
 
@@ -119,13 +331,65 @@ def generate_dummy_review(book):
 强烈推荐给所有热爱阅读的朋友们！
 """
 
-def generate_review(book, api_key, dry_run=False):
-    """Generate a book review using the Nvidia DeepSeek R1 API."""
-    if dry_run:
-        print(f"[Dry Run] Generating dummy review for '{book['title']}'")
-        return generate_dummy_review(book)
+def stream_completion(session, headers, body):
+    """Send a streaming chat completion request and return the generated text.
+
+    The raw text is returned once the stream has finished: think blocks are only
+    stripped afterwards, since the raw text is what gets cached, and a review is
+    only written once the response is known to be complete.
+
+    Raises IncompleteResponseError if the model stopped because it ran out of
+    tokens, and StreamInterruptedError if the connection fails while the response
+    body is being read or the stream ends without "data: [DONE]".
+    """
+    parts = []
+    finish_reason = None
+    done = False
+    with session.post(NVIDIA_API_URL, headers=headers, data=body, stream=True,
+                      timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()  # Raise exception for non-200 status codes
+        try:
+            for line in response.iter_lines():
+                # Server-sent events: "data: {...}" frames terminated by "data: [DONE]"
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    done = True
+                    break
+                chunk = orjson.loads(data)
+                if not chunk.get("choices"):
+                    continue
+                choice = chunk["choices"][0]
+                finish_reason = choice.get("finish_reason") or finish_reason
+                text = choice["delta"].get("content")
+                if text:
+                    parts.append(text)
+        except requests.exceptions.RequestException as e:
+            # The session's Retry does not cover the body of a streamed response
+            # (e.g. ChunkedEncodingError when the connection drops mid-response,
+            # or ConnectionError when it stalls past the read timeout)
+            raise StreamInterruptedError(str(e)) from e
     
-    prompt = f"""
+    if not done:
+        # The server closed the connection early; retrying may well succeed
+        raise StreamInterruptedError("stream ended before [DONE]")
+    if finish_reason == "length":
+        raise IncompleteResponseError("response truncated at max_tokens")
+    return "".join(parts)
+
+def format_book_info(book):
+    """Format the book details included in review prompts."""
+    return f"""- 作者：{book['author']}
+- 原书名：{book['original_title']}
+- 出版年份：{book['year']}
+- 出版社：{book['publisher']}
+- 豆瓣评分：{book['rating']}
+- 豆瓣短评：{book['comment']}"""
+
+def build_prompt(book):
+    """Build the prompt asking for a review of a single book."""
+    return f"""
 请你写一篇关于《{book['title']}》的书评，以发布在小红书平台上。
 要求：
 1. 字数控制在300-500字
@@ -135,16 +399,38 @@ def generate_review(book, api_key, dry_run=False):
 5. 提到作者{book['author']}的写作风格特点
 
 书籍信息：
-- 作者：{book['author']}
-- 原书名：{book['original_title']}
-- 出版年份：{book['year']}
-- 出版社：{book['publisher']}
-- 豆瓣评分：{book['rating']}
-- 豆瓣短评：{book['comment']}
+{format_book_info(book)}
 
 请直接给出书评内容，不要有多余的解释。
 """
 
+def build_batch_prompt(books):
+    """Build the prompt asking for one review per book, separated by BOOK_SEPARATOR."""
+    book_infos = "\n\n".join(
+        f"{i}. 《{book['title']}》\n{format_book_info(book)}" for i, book in enumerate(books, 1)
+    )
+    return f"""
+请为以下{len(books)}本书各写一篇书评，以发布在小红书平台上。
+要求：
+1. 每篇书评字数控制在300-500字
+2. 风格要符合小红书的文风，生动活泼，有吸引力
+3. 引用书中的经典段落或观点
+4. 给出个人感受和推荐理由
+5. 提到每本书作者的写作风格特点
+6. 按书籍信息中的顺序输出，每两篇书评之间单独一行写 {BOOK_SEPARATOR} 作为分隔
+
+书籍信息：
+{book_infos}
+
+请直接给出书评内容，不要有多余的解释。
+"""
+
+async def request_completion(prompt, label, session, api_key, use_cache=True, pacer=None, parse=None):
+    """Send a prompt to the Nvidia DeepSeek R1 API and return the text without think blocks.
+
+    If given, ``parse`` converts that text into the return value and raises
+    IncompleteResponseError when it is unusable; only responses that parse are cached.
+    """
     headers = {
         "accept": "application/json",
         "content-type": "application/json",
@@ -157,8 +443,8 @@ def generate_review(book, api_key, dry_run=False):
         "top_p": 0.7,
         "frequency_penalty": 0,
         "presence_penalty": 0,
-        "max_tokens": 4096,
-        "stream": False,
+        "max_tokens": MAX_TOKENS,
+        "stream": True,
         "messages": [
             {
                 "role": "user",
@@ -167,74 +453,344 @@ def generate_review(book, api_key, dry_run=False):
         ]
     }
     
+    # Serialize once: the same bytes are hashed for the cache key and sent as the body
+    body = orjson.dumps(payload)
+    
+    # Identical payloads (model, parameters and prompt) reuse the cached response
+    cache_path = get_cache_path(body)
+    # Cache files are read and written in worker threads to keep the event loop free
+    result = await asyncio.to_thread(load_cached_response, cache_path) if use_cache else None
+    cached = result is not None
+    
     try:
-        print(f"正在调用API生成《{book['title']}》的书评...")
-        response = requests.post(NVIDIA_API_URL, headers=headers, json=payload)
-        response.raise_for_status()  # Raise exception for non-200 status codes
+        if cached:
+            print(f"使用缓存的API响应生成{label}的书评")
+            # Remove thinking process from the response
+            content = remove_think_tags(result["choices"][0]["message"]["content"])
+            return parse(content) if parse else content
         
-        result = response.json()
-        content = result["choices"][0]["message"]["content"]
+        if pacer:
+            await pacer.wait()
+        print(f"正在调用API生成{label}的书评...")
+        # Run the blocking streaming request in a worker thread so other books can proceed
+        raw_content = await asyncio.to_thread(stream_completion, session, headers, body)
         # Remove thinking process from the response
-        content = remove_think_tags(content)
-        return content
+        content = remove_think_tags(raw_content)
+        parsed = parse(content) if parse else content
+        if raw_content:
+            # Cache the unfiltered text in the same shape as a non-streamed response
+            result = {"choices": [{"message": {"role": "assistant", "content": raw_content}}]}
+            await asyncio.to_thread(save_cached_response, cache_path, result)
+        return parsed
     except requests.exceptions.RequestException as e:
-        print(f"Error calling API for book '{book['title']}': {str(e)}")
-        if hasattr(e, 'response') and e.response:
+        status = e.response.status_code if e.response is not None else None
+        if status in OVERLOAD_STATUSES:
+            # Let the caller back off and retry instead of skipping the book
+            retry_after = parse_retry_after(e.response.headers.get("Retry-After"))
+            raise RateLimitError(f"HTTP {status}", retry_after) from e
+        if status in REJECTED_STATUSES:
+            # The caller decides whether a smaller request is worth trying
+            raise RequestRejectedError(f"HTTP {status}") from e
+        print(f"Error calling API for {label}: {str(e)}")
+        # Response.__bool__ is response.ok, so test for None explicitly
+        if e.response is not None:
             print(f"Response: {e.response.text}")
         return None
-    except (KeyError, IndexError) as e:
-        print(f"Error parsing API response for book '{book['title']}': {str(e)}")
-        print(f"Response: {response.text if response else 'No response'}")
+    except (KeyError, IndexError, orjson.JSONDecodeError) as e:
+        print(f"Error parsing API response for {label}: {str(e)}")
+        if result is not None:
+            print(f"Response: {result}")
         return None
 
+async def generate_review(book, session, api_key, dry_run=False, use_cache=True, pacer=None):
+    """Generate a book review using the Nvidia DeepSeek R1 API.
+
+    Raises IncompleteResponseError if the response holds no review text; such
+    responses are not cached.
+    """
+    if dry_run:
+        print(f"[Dry Run] Generating dummy review for '{book['title']}'")
+        return generate_dummy_review(book)
+    
+    return await request_completion(build_prompt(book), f"《{book['title']}》", session, api_key, use_cache, pacer,
+                                    parse=require_review)
+
+def require_review(content):
+    """Return content, raising IncompleteResponseError if it holds no review (e.g. only a think block)."""
+    if not content.strip():
+        raise IncompleteResponseError("no review text outside the think block")
+    return content
+
+def split_reviews(content, count):
+    """Split a batch response into its reviews, raising IncompleteResponseError unless there are count of them."""
+    reviews = [review.strip() for review in content.split(BOOK_SEPARATOR)]
+    reviews = [review for review in reviews if review]
+    if len(reviews) != count:
+        raise IncompleteResponseError(f"expected {count} reviews, got {len(reviews)}")
+    return reviews
+
+async def generate_batch_reviews(books, session, api_key, dry_run=False, use_cache=True, pacer=None):
+    """Generate reviews for several books with a single API request.
+
+    Returns the reviews in the same order as books, or None if the request
+    failed. Raises IncompleteResponseError if the response did not split into
+    exactly one review per book, and RequestRejectedError if the API rejected
+    the request as invalid.
+    """
+    if dry_run:
+        print(f"[Dry Run] Generating dummy reviews for {len(books)} books")
+        return [generate_dummy_review(book) for book in books]
+    
+    label = "、".join(f"《{book['title']}》" for book in books)
+    return await request_completion(build_batch_prompt(books), label, session, api_key, use_cache, pacer,
+                                    parse=lambda content: split_reviews(content, len(books)))
+
 def get_review_path(book, output_dir):
     """Get the path for a book review file."""
     # Create a valid filename from the book title
-    filename = re.sub(r'[\\/*?:"<>|]', '', book['title'])
+    filename = FILENAME_SANITIZE_RE.sub('', book['title'])
     filename = filename.replace(' ', '_')
     return os.path.join(output_dir, f"{filename}.md")
 
-def save_review(book, review, output_dir, overwrite=True):
-    """Save the generated review to a markdown file."""
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-    
+def save_review(book, review, output_dir, existing, overwrite=True):
+    """Save the generated review to a markdown file.
+
+    The output directory must already exist; ``existing`` is the set of file
+    names already in it and is updated with the new file. Returns True if the
+    file was written, False if an existing file was kept.
+    """
     file_path = get_review_path(book, output_dir)
+    filename = os.path.basename(file_path)
     
     # Check if file exists
-    if os.path.exists(file_path):
+    if filename in existing:
         if not overwrite:
             print(f"跳过 - 文件已存在: {file_path}")
-            return file_path
+            return False
         else:
             print(f"覆盖旧文件: {file_path}")
     
+    # Format the whole file up front so it goes out in a single write
+    content = (
+        f"# 《{book['title']}》书评\n\n"
+        f"作者: {book['author']}  \n"
+        f"豆瓣评分: {book['rating']}  \n\n"
+        f"{review}\n"
+    )
+    
     # Write to file (overwriting if it exists)
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(f"# 《{book['title']}》书评\n\n")
-        f.write(f"作者: {book['author']}  \n")
-        f.write(f"豆瓣评分: {book['rating']}  \n\n")
-        f.write(f"{review}\n")
+    with open(file_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(content)
+    existing.add(filename)
     
     print(f"成功保存书评: {file_path}")
-    return file_path
+    return True
+
+def is_dummy_review(file_path):
+    """Return True if the review file was written by a dry run."""
+    try:
+        with open(file_path, encoding='utf-8') as f:
+            return DUMMY_REVIEW_MARKER in f.read()
+    except (OSError, UnicodeDecodeError):
+        return False
+
+def has_real_review(review_path, existing):
+    """Return True if the review file exists and is not a dry run's dummy review."""
+    return os.path.basename(review_path) in existing and not is_dummy_review(review_path)
+
+class ReviewManifest:
+    """Titles of books whose reviews have been saved, kept in a JSON file in the output directory.
+
+    Loaded once per run so --no-overwrite needs no per-book file checks, and
+    rewritten after every saved review so an interrupted run can be resumed.
+    add() is called from worker threads, so updates are serialized by a lock.
+    """
+    
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, 'rb') as f:
+                self.done = set(orjson.loads(f.read()))
+        except (OSError, orjson.JSONDecodeError, TypeError):
+            # Missing, corrupt, or valid JSON that is not a list of titles
+            self.done = set()
+    
+    def __contains__(self, title):
+        return title in self.done
+    
+    def add(self, title):
+        """Record a saved review and rewrite the manifest atomically."""
+        self.update([title])
+    
+    def update(self, titles):
+        """Record several saved reviews with a single rewrite of the manifest."""
+        with self._lock:
+            self.done.update(titles)
+            self._write()
+    
+    def discard(self, title):
+        """Forget a review that has been replaced, e.g. by a dry run's dummy review."""
+        with self._lock:
+            if title in self.done:
+                self.done.discard(title)
+                self._write()
+    
+    def _write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(sorted(self.done)))
+        os.replace(tmp_path, self.path)
+
+async def run_limited(limiter, label, make_request):
+    """Run an API request under the limiter, retrying it after overloads and interrupted streams.
+
+    Each overload shrinks the limiter; the retry then waits as long as the
+    server's Retry-After header asks, or backs off exponentially with jitter.
+    Returns the request's result, or None if it still failed after
+    MAX_OVERLOAD_RETRIES retries.
+    """
+    for attempt in range(MAX_OVERLOAD_RETRIES + 1):
+        generation = await limiter.acquire()
+        overloaded = False
+        succeeded = False
+        try:
+            result = await make_request()
+            succeeded = True
+            return result
+        except RateLimitError as e:
+            overloaded = True
+            error = e
+            retry_after = e.retry_after
+        except StreamInterruptedError as e:
+            error = e
+            retry_after = None
+        finally:
+            # Also frees the slot when make_request raises anything else; only
+            # successful requests may grow the limit
+            await limiter.release(generation, overloaded, succeeded)
+        
+        if attempt == MAX_OVERLOAD_RETRIES:
+            break
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = RETRY_BACKOFF_FACTOR * 2 ** attempt + random.uniform(0, RETRY_BACKOFF_JITTER)
+        # Wait without holding a slot so other books can use the reduced limit
+        if overloaded:
+            print(f"{label}请求被限流 ({error})，{delay:.1f} 秒后重试...")
+        else:
+            print(f"{label}的响应连接中断 ({error})，{delay:.1f} 秒后重试...")
+        await asyncio.sleep(delay)
+    
+    print(f"Error calling API for {label}: still failing after {MAX_OVERLOAD_RETRIES} retries ({error})")
+    return None
+
+async def process_batch(batch, total, session, api_key, args, limiter, pacer, existing, manifest):
+    """Generate and save the reviews for a batch of (index, book) pairs."""
+    books = [book for _, book in batch]
+    label = "、".join(f"《{book['title']}》" for book in books)
+    
+    async def make_request():
+        for index, book in batch:
+            print(f"\n处理第 {index}/{total} 本书: {book['title']}")
+        if len(books) == 1:
+            return [await generate_review(books[0], session, api_key, args.dry_run, not args.no_cache, pacer)]
+        return await generate_batch_reviews(books, session, api_key, args.dry_run, not args.no_cache, pacer)
+    
+    reviews = None
+    fall_back = False
+    try:
+        reviews = await run_limited(limiter, label, make_request)
+    except IncompleteResponseError as e:
+        print(f"{label}的API响应不完整: {e}")
+        fall_back = True
+    except RequestRejectedError as e:
+        print(f"API拒绝了{label}的请求: {e}")
+        fall_back = True
+    
+    # Only an unusable or rejected batch request is retried one book per request;
+    # other failures (e.g. a rejected API key) would just fail K more times
+    if fall_back and len(batch) > 1:
+        print(f"改为逐本生成{label}的书评")
+        await asyncio.gather(*(process_batch([item], total, session, api_key, args, limiter, pacer, existing, manifest)
+                               for item in batch))
+        return
+    if reviews is None:
+        reviews = [None] * len(books)
+    
+    def save_and_record(book, review):
+        # Save review (overwrite if exists unless --no-overwrite is set). Dummy
+        # reviews are always replaced, and a dry run never replaces a real review.
+        review_path = get_review_path(book, args.output_dir)
+        keep = (args.no_overwrite or args.dry_run) and has_real_review(review_path, existing)
+        if save_review(book, review, args.output_dir, existing, not keep):
+            # Dummy reviews from a dry run must not count as finished
+            if args.dry_run:
+                manifest.discard(book['title'])
+            else:
+                manifest.add(book['title'])
+        elif not args.dry_run:
+            # The file that was kept is a real review from an earlier run
+            manifest.add(book['title'])
+    
+    for book, review in zip(books, reviews):
+        if review:
+            await asyncio.to_thread(save_and_record, book, review)
+        else:
+            print(f"为《{book['title']}》生成书评失败")
+
+async def generate_all_reviews(books, api_key, args):
+    """Generate reviews for all books, adapting the number of requests in flight."""
+    limiter = AdaptiveConcurrencyLimiter(args.concurrency)
+    pacer = RequestPacer(args.min_interval)
+    # Size the worker threads to the limiter so every slot it hands out gets a thread
+    # right away (the default executor has only min(32, cpu_count + 4) threads)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=limiter.maximum))
+    # Create the output directory and list its files once instead of once per book
+    os.makedirs(args.output_dir, exist_ok=True)
+    existing = {entry.name for entry in os.scandir(args.output_dir)}
+    manifest = ReviewManifest(args.output_dir)
+    
+    pending = []
+    unrecorded = []
+    for i, book in enumerate(books):
+        # Check if review already exists
+        review_path = get_review_path(book, args.output_dir)
+        if args.no_overwrite and book['title'] in manifest:
+            print(f"跳过 - 书评已存在: {review_path}")
+            continue
+        # Reviews saved before the manifest existed only show up as files; dry-run
+        # dummies are left out so those books are generated for real
+        if args.no_overwrite and has_real_review(review_path, existing):
+            print(f"跳过 - 书评已存在: {review_path}")
+            unrecorded.append(book['title'])
+            continue
+        pending.append((i + 1, book))
+    if unrecorded and not args.dry_run:
+        manifest.update(unrecorded)
+    
+    # Group books so each API request reviews up to args.batch_size of them
+    batches = [pending[i:i + args.batch_size] for i in range(0, len(pending), args.batch_size)]
+    # One session for the whole run so the TLS connection is reused across books
+    with create_session(limiter.maximum) as session:
+        await asyncio.gather(*(process_batch(batch, len(books), session, api_key, args, limiter, pacer, existing, manifest)
+                               for batch in batches))
 
 def main():
     # Parse command line arguments
     args = parse_arguments()
     
-    # Get API key from .env file (not needed in dry-run mode)
+    # Check the API key from .env file before any other startup work (not needed in dry-run mode)
     api_key = None
-    if not args.dry_run:
-        api_key = os.environ.get("api_key")
+    if not args.dry_run and not (api_key := API_KEY):
+        api_key = input("API key not found in .env file. Please enter your Nvidia API key: ")
         if not api_key:
-            api_key = input("API key not found in .env file. Please enter your Nvidia API key: ")
-            if not api_key:
-                print("No API key provided. Exiting.")
-                return
+            print("No API key provided. Exiting.")
+            return
     
-    # Select markdown file
-    file_path = select_file()
+    # Select markdown file (file dialog only with --gui)
+    file_path = select_file() if args.gui else args.input
     if not os.path.exists(file_path):
         print(f"File not found: {file_path}")
         return
@@ -251,30 +807,12 @@ def main():
         print("运行在【模拟模式】(不会调用API)")
     if args.no_overwrite:
         print("运行在【不覆盖模式】(已有书评将被跳过)")
+    print(f"初始并发请求数: {args.concurrency}")
+    if args.batch_size > 1:
+        print(f"每个请求生成 {args.batch_size} 本书的书评")
     
-    # Generate reviews for each book
-    for i, book in enumerate(books):
-        print(f"\n处理第 {i+1}/{len(books)} 本书: {book['title']}")
-        
-        # Check if review already exists
-        review_path = get_review_path(book, args.output_dir)
-        if os.path.exists(review_path) and args.no_overwrite:
-            print(f"跳过 - 书评已存在: {review_path}")
-            continue
-        
-        # Add delay to respect API rate limits (not needed in dry-run mode)
-        if i > 0 and not args.dry_run:
-            delay_time = 2  # 2-second delay between requests
-            print(f"等待 {delay_time} 秒以避免API限流...")
-            time.sleep(delay_time)
-        
-        # Generate review
-        review = generate_review(book, api_key, args.dry_run)
-        if review:
-            # Save review (overwrite if exists unless --no-overwrite is set)
-            save_review(book, review, args.output_dir, not args.no_overwrite)
-        else:
-            print(f"为《{book['title']}》生成书评失败")
+    # Generate reviews, overlapping the API calls for different books
+    asyncio.run(generate_all_reviews(books, api_key, args))
     
     print(f"\n所有书评已生成! 文件保存在 '{args.output_dir}' 目录下。")
 